@@ -1,35 +1,43 @@
 # stdlib imports
 import os.path
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timedelta
 from urllib.request import urlopen
 from urllib.parse import urlparse
 from io import StringIO
 import re
-import json
+from concurrent.futures import ThreadPoolExecutor
+import functools
 
 # third party imports
 import yaml
 import boto3
-from boto3.s3.transfer import TransferConfig
-import defusedxml.cElementTree as dET
-from sqlalchemy import and_
-import pandas as pd
+from botocore.config import Config
+import defusedxml.ElementTree as dET
+from sqlalchemy import and_, or_, select, update, delete
+from sqlalchemy.orm import selectinload, raiseload
 import numpy as np
+import orjson
 
 # local imports
 from associate_amps.amps_db import Event, Station, Channel, PGM, get_session
 
+_PGM_INSERT = PGM.__table__.insert()
+
 MAX_SIZE = 4096
 # Times can have either integer or floating point (preferred) seconds
 TIMEFMT = '%Y-%m-%dT%H:%M:%S.%fZ'
 ALT_TIMEFMT = '%Y-%m-%dT%H:%M:%SZ'
+_TIMEFMT_NOZ = TIMEFMT.replace('Z', '')
+_ALT_TIMEFMT_NOZ = ALT_TIMEFMT.replace('Z', '')
 
 QUEUE_URL = 'QUEUE_URL'
 DB_URL = 'DB_URL'
 S3_BUCKET_URL = 'S3_BUCKET_URL'
+# set to make unexpected lazy loads of event data raise (for testing)
+RAISELOAD = 'AMPS_RAISELOAD'
 
-MB = 1048576
-PAYLOAD_LIMIT = 5242880
+# number of threads used to upload event JSON to S3
+MAX_UPLOAD_WORKERS = 16
 
 IMTS = ['acc', 'vel', 'sa', 'pga', 'pgv']
 IMTDICT = {'acc': 'pga',
@@ -44,7 +52,7 @@ TMAX = 180
 DISTANCE = 500
 P_TRAVEL_TIME = 4.2
 
-FLOAT_PATTERN = r'[-+]?[0-9]*\.?[0-9]+'
+_NON_ASCII_RE = re.compile(rb'[^\x00-\x7F]+')
 
 UNITS = {'PGA': '%g',
          'PGV': 'cm/s',
@@ -60,6 +68,9 @@ MAX_AMP_AGE = 15
 # number of days after origin time that earthquakes should be deleted
 MAX_EVENT_AGE = 90
 
+# reference time fields used when an amps file has no PGMTime
+TIME_FIELDS = ['year', 'month', 'day', 'hour', 'minute', 'second', 'msec']
+
 # number of seconds +/- to search for stations in the database
 STATION_WINDOW_SECS = 10
 
@@ -86,13 +97,15 @@ def insert_event(eventdict):
     db_url = os.environ[DB_URL]
     session = get_session(db_url)
 
-    # First ask if the event is already in the database
+    # First ask if the event is already in the database, under its own id
+    # or any of its alternate ids; if several match, prefer them in that
+    # order
     allids = [eventdict['eventid']] + eventdict['ids']
-    for eid in allids:
-        eventobj = session.query(Event).filter(Event.eventid == eid).first()
-        if eventobj is None:
-            continue
-        break
+    matches = session.scalars(
+        select(Event).where(Event.eventid.in_(allids))).all()
+    eventobj = None
+    if len(matches):
+        eventobj = min(matches, key=lambda match: allids.index(match.eventid))
 
     # if we found it, update the information about the event
     if eventobj is not None:
@@ -131,55 +144,29 @@ def insert_amps(ampsurl):
     if DB_URL not in os.environ:
         raise KeyError(f"Database URL {DB_URL} not in environment.")
     db_url = os.environ[DB_URL]
-    session = get_session(db_url)
     try:
         with urlopen(ampsurl) as fh:
-            xmlstr = fh.read().decode('utf8')
-        # sometimes these records have non-ascii bytes in them
-        newxmlstr = re.sub(r'[^\x00-\x7F]+', ' ', xmlstr)
-        newxmlstr = newxmlstr.encode('utf-8', errors='xmlcharrefreplace')
-        amps = dET.fromstring(newxmlstr)
+            amps = _parse_amps(fh)
     except Exception as e:
         raise Exception('Could not parse %s, due to error "%s"' %
                         (ampsurl, str(e)))
 
-    if amps.tag != 'amplitudes':
+    if amps['tag'] != 'amplitudes':
         raise Exception('%s does not appear to be an amplitude XML '
                         'file.' % ampsurl)
-    agency = amps.get('agency')
-    record = amps.find('record')
-    timing = record.find('timing')
-    reference = timing.find('reference')
-    has_pgm = False
-    time_dict = {}
-    for child in reference.iter():
-        node_name = child.tag
-        if node_name == 'PGMTime':
-            has_pgm = True
-        elif node_name == 'year':
-            time_dict['year'] = int(child.get('value'))
-        elif node_name == 'month':
-            time_dict['month'] = int(child.get('value'))
-        elif node_name == 'day':
-            time_dict['day'] = int(child.get('value'))
-        elif node_name == 'hour':
-            time_dict['hour'] = int(child.get('value'))
-        elif node_name == 'minute':
-            time_dict['minute'] = int(child.get('value'))
-        elif node_name == 'second':
-            time_dict['second'] = int(child.get('value'))
-        elif node_name == 'msec':
-            time_dict['msec'] = int(child.get('value'))
+    agency = amps['agency']
+    has_pgm = amps['pgmtime'] is not None
+    time_dict = amps['time_dict']
+    # pgmdate is naive UTC, like every other time in the database
     if has_pgm:
-        pgmtime_str = reference.find('PGMTime').text
+        pgmtime_str = amps['pgmtime'][0:19]
         try:
-            tfmt = TIMEFMT.replace('Z', '')
-            pgmdate = datetime.strptime(
-                pgmtime_str[0:19], tfmt).replace(tzinfo=timezone.utc)
+            pgmdate = datetime.fromisoformat(pgmtime_str)
         except ValueError:
-            tfmt = ALT_TIMEFMT.replace('Z', '')
-            pgmdate = datetime.strptime(
-                pgmtime_str[0:19], tfmt).replace(tzinfo=timezone.utc)
+            try:
+                pgmdate = datetime.strptime(pgmtime_str, _TIMEFMT_NOZ)
+            except ValueError:
+                pgmdate = datetime.strptime(pgmtime_str, _ALT_TIMEFMT_NOZ)
     else:
         if not len(time_dict):
             print('No time data for file %s' % ampsurl)
@@ -194,8 +181,7 @@ def insert_amps(ampsurl):
     # there are often multiple stations per file, but they're
     # all duplicates of each other, so just grab the information
     # from the first one
-    station = record.find('station')
-    attrib = dict(station.items())
+    attrib = amps['station']
     lat = float(attrib['lat'])
     lon = float(attrib['lon'])
     code = attrib['code']
@@ -207,55 +193,11 @@ def insert_amps(ampsurl):
     else:
         network = agency
     #
-    # The station (at this pgmtime +/- 10 seconds) might already exist
-    # in the DB; if it does, use it
-    #
-    minustime = pgmdate - timedelta(seconds=STATION_WINDOW_SECS)
-    plustime = pgmdate + timedelta(seconds=STATION_WINDOW_SECS)
-    rows = session.query(Station.id, Station.timestamp).\
-        filter(Station.network == network).\
-        filter(Station.code == code).\
-        filter(Station.timestamp > minustime).\
-        filter(Station.timestamp < plustime).with_for_update().all()
-    #
-    # It's possible that the query returned more than one station; pick
-    # the one closest to the new station's pgmtime
-    #
-    best_sid = None
-    best_time = None
-    for row in rows:
-        dtime = abs((row[1] - pgmdate) / timedelta(seconds=1))
-        if best_time is None or dtime < best_time:
-            best_time = dtime
-            best_sid = row[0]
-    inserted_station = False
-    if best_sid is None:
-        station = Station(event_id=None,
-                          timestamp=pgmdate,
-                          lat=lat,
-                          lon=lon,
-                          name=name,
-                          code=code,
-                          network=network,
-                          loadtime=datetime.utcnow(),
-                          )
-        session.add(station)
-        session.commit()
-        best_sid = station.id
-        inserted_station = True
-
-    #
-    # If the station is already there, it has at least one channel, too
+    # Work out which channels and IMTs are worth keeping before touching
+    # the database at all
     #
-    existing_channels = {}
-    if inserted_station is False:
-        rows = session.query(Channel.channel, Channel.id).\
-            filter(Station.station_id == best_sid).all()
-        existing_channels = dict(rows)
-
-    # loop over components
-    channels_inserted = 0
-    for channel in record.iter('component'):
+    components = []
+    for channel, pgms in amps['components']:
         # We don't want channels with qual > 4 (assuming qual is Cosmos
         # table 6 value)
         qual = channel.get('qual')
@@ -273,31 +215,9 @@ def insert_amps(ampsurl):
         if not loc:
             loc = '--'
         cname = channel.get('name')
-        if cname in existing_channels:
-            best_cid = existing_channels[cname]
-            inserted_channel = False
-        else:
-            channelobj = Channel(station_id=best_sid, channel=cname, loc=loc)
-            session.add(channelobj)
-            session.commit()
-            best_cid = channelobj.id
-            inserted_channel = True
-            channels_inserted += 1
-
-        #
-        # Similarly, if the channel is already there, we don't want to
-        # insert repeated IMTs (and updating them doesn't make a lot of
-        # sense)
-        #
-        existing_pgms = {}
-        if inserted_channel is False:
-            rows = session.query(PGM.imt, PGM.id).\
-                filter(PGM.channel_id == best_cid)
-            existing_pgms = dict(rows)
         # loop over imts in channel
-        pgm_list = []
-        for pgm in list(channel):
-            imt = pgm.tag
+        pgm_values = []
+        for imt, pgm in pgms:
             if imt not in IMTS:
                 continue
             try:
@@ -314,39 +234,182 @@ def insert_amps(ampsurl):
                 imt = IMTDICT[imt]
             if imt == 'pga':
                 value = value / 9.81
-            if imt in existing_pgms:
-                continue
-            pgm = PGM(channel_id=best_cid, imt=imt, value=value)
-            pgm_list.append(pgm)
-        if len(pgm_list) > 0:
-            #
-            # Insert the new amps
-            #
-            session.bulk_save_objects(pgm_list)
-            session.commit()
-        elif inserted_channel:
+            pgm_values.append((imt, value))
+        if len(pgm_values):
+            components.append((cname, loc, pgm_values))
+    if not len(components):
+        return
+
+    session = get_session(db_url)
+    #
+    # The station (at this pgmtime +/- 10 seconds) might already exist
+    # in the DB; if it does, use it
+    #
+    minustime = pgmdate - timedelta(seconds=STATION_WINDOW_SECS)
+    plustime = pgmdate + timedelta(seconds=STATION_WINDOW_SECS)
+    query = select(Station.id, Station.timestamp).\
+        where(Station.network == network).\
+        where(Station.code == code).\
+        where(Station.timestamp > minustime).\
+        where(Station.timestamp < plustime).with_for_update()
+    rows = session.execute(query).all()
+    #
+    # It's possible that the query returned more than one station; pick
+    # the one closest to the new station's pgmtime
+    #
+    best_sid = None
+    if len(rows):
+        best_sid = min(rows, key=lambda row: abs(row[1] - pgmdate))[0]
+    inserted_station = False
+    if best_sid is None:
+        station = Station(event_id=None,
+                          timestamp=pgmdate,
+                          lat=lat,
+                          lon=lon,
+                          name=name,
+                          code=code,
+                          network=network,
+                          loadtime=datetime.utcnow(),
+                          )
+        session.add(station)
+        # flush (rather than commit) to get the new station id; the
+        # whole file goes in as a single transaction
+        session.flush()
+        best_sid = station.id
+        inserted_station = True
+
+    #
+    # If the station is already there, it has at least one channel, too;
+    # get all of its channels and their IMTs in one query, as
+    # {channel name: (channel id, set of imts)}
+    #
+    existing_channels = {}
+    if inserted_station is False:
+        query = select(Channel.channel, Channel.id, PGM.imt).\
+            outerjoin(PGM, PGM.channel_id == Channel.id).\
+            where(Channel.station_id == best_sid)
+        rows = session.execute(query).all()
+        for cname, cid, imt in rows:
+            if cname not in existing_channels:
+                existing_channels[cname] = (cid, set())
+            if imt is not None:
+                existing_channels[cname][1].add(imt)
+
+    # loop over components
+    all_pgms = []
+    new_channels = []
+    for cname, loc, pgm_values in components:
+        if cname in existing_channels:
             #
-            # If we didn't insert any amps, but we inserted the channel,
-            # delete the channel
+            # If the channel is already there, we don't want to
+            # insert repeated IMTs (and updating them doesn't make a lot
+            # of sense)
             #
-            channel = session.query(Channel).\
-                filter(Channel.id == best_cid).first()
-            session.delete(channel)
-            session.commit()
-            channels_inserted -= 1
-        # End of pgm loop
+            best_cid, existing_pgms = existing_channels[cname]
+            all_pgms.extend({'channel_id': best_cid,
+                             'imt': imt,
+                             'value': value}
+                            for imt, value in pgm_values
+                            if imt not in existing_pgms)
+        else:
+            channelobj = Channel(station_id=best_sid, channel=cname, loc=loc)
+            new_channels.append((channelobj, pgm_values))
     # End of channel loop
 
-    #
-    # If we inserted the station but no channels, delete the station
-    #
-    if channels_inserted == 0 and inserted_station:
-        station = session.query(Station).filter(Station.id == best_sid).first()
-        session.delete(station)
-        session.commit()
+    if len(new_channels):
+        #
+        # Insert all of the new channels in one flush; SQLAlchemy batches
+        # the INSERTs (with RETURNING for the ids) where the database
+        # supports it
+        #
+        session.add_all([channelobj for channelobj, _ in new_channels])
+        session.flush()
+        for channelobj, pgm_values in new_channels:
+            all_pgms.extend({'channel_id': channelobj.id,
+                             'imt': imt,
+                             'value': value}
+                            for imt, value in pgm_values)
+
+    if len(all_pgms):
+        # a Core executemany skips the ORM mapper entirely
+        session.execute(_PGM_INSERT, all_pgms)
+    session.commit()
     session.close()
 
 
+class _AsciiReader(object):
+    """Read-only file wrapper that replaces non-ASCII bytes with spaces.
+
+    Sometimes amps records have non-ascii bytes in them, which the XML
+    parser rejects in a file that declares itself US-ASCII.
+    """
+
+    def __init__(self, fh):
+        self._fh = fh
+
+    def read(self, size=-1):
+        return _NON_ASCII_RE.sub(b' ', self._fh.read(size))
+
+
+def _parse_amps(fh):
+    """Stream-parse the first record of an amps XML file.
+
+    Elements are cleared as soon as they have been read, so the parser
+    never holds more than one component of the document in memory.
+
+    Args:
+        fh (file): Binary file object containing amps XML.
+    Returns:
+        dict: Dictionary with the following keys:
+              - tag (root element tag)
+              - agency (root agency attribute)
+              - pgmtime (PGMTime string, or None)
+              - time_dict (reference time fields, if no PGMTime)
+              - station (attributes of the first station, or None)
+              - components (list of (attributes, [(imt, attributes)])
+                tuples for every component in the record)
+    """
+    amps = {'tag': None,
+            'agency': None,
+            'pgmtime': None,
+            'time_dict': {},
+            'station': None,
+            'components': [],
+            }
+    in_reference = False
+    for action, elem in dET.iterparse(_AsciiReader(fh),
+                                      events=('start', 'end')):
+        if action == 'start':
+            if amps['tag'] is None:
+                amps['tag'] = elem.tag
+                if elem.tag != 'amplitudes':
+                    break
+                amps['agency'] = elem.get('agency')
+            elif elem.tag == 'reference':
+                in_reference = True
+            elif elem.tag == 'station' and amps['station'] is None:
+                amps['station'] = dict(elem.items())
+            continue
+        tag = elem.tag
+        if in_reference:
+            if tag == 'reference':
+                in_reference = False
+            elif tag == 'PGMTime':
+                amps['pgmtime'] = elem.text
+            elif tag in TIME_FIELDS:
+                amps['time_dict'][tag] = int(elem.get('value'))
+        elif tag == 'component':
+            pgms = [(pgm.tag, dict(pgm.items())) for pgm in elem]
+            amps['components'].append((dict(elem.items()), pgms))
+            elem.clear()
+        elif tag == 'station':
+            elem.clear()
+        elif tag == 'record':
+            # only the first record is used
+            break
+    return amps
+
+
 def associate_amps():
     """Attempt to associate amplitudes with appropriate events.
 
@@ -361,24 +424,90 @@ def associate_amps():
     session = get_session(db_url)
 
     # get all earthquakes
-    events = session.query(Event).all()
-    for event in events:
-        associate(session, event)
-        if len(event.stations):
-            write_event_to_s3(event)
-        # now delete all of the stations newly
-        # associated with the event
-        stations = session.query(Station).\
-            filter(Station.event_id == event.id).all()
-        for station in stations:
-            session.delete(station)
-        session.commit()
+    events = session.scalars(select(Event)).all()
+    # The JSON has to be built here, as the session can't be shared
+    # with the upload threads; only the uploads run in parallel
+    with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+        futures = []
+        for event in events:
+            associate(session, event)
+            event = _load_event_stations(session, event)
+            if len(event.stations):
+                eventjson = get_metrics_json(event)
+                future = executor.submit(_put_event_json,
+                                         _get_s3_client(),
+                                         event.eventid, eventjson)
+                futures.append((event.id, future))
+
+        written_ids = []
+        failed_ids = []
+        upload_error = None
+        for event_id, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failed_ids.append(event_id)
+                if upload_error is None:
+                    upload_error = e
+            else:
+                written_ids.append(event_id)
+
+    # now delete all of the stations newly associated with the events
+    # in a single statement; channels and pgms go with them through the
+    # foreign key cascades
+    if len(written_ids):
+        stmt = delete(Station).\
+            where(Station.event_id.in_(written_ids)).\
+            execution_options(synchronize_session=False)
+        session.execute(stmt)
+    # stations of events that could not be uploaded go back to being
+    # unassociated, so that the next run picks them up again
+    if len(failed_ids):
+        stmt = update(Station).\
+            where(Station.event_id.in_(failed_ids)).\
+            values(event_id=None).\
+            execution_options(synchronize_session=False)
+        session.execute(stmt)
+    session.commit()
     session.close()
 
+    if upload_error is not None:
+        raise upload_error
+
+
+def _load_event_stations(session, event):
+    """Load an event with its stations, channels and pgms.
+
+    The whole tree that get_metrics_json() walks is fetched with one
+    SELECT per level, instead of one lazy load per station and channel.
+    If the AMPS_RAISELOAD environment variable is set (as the tests do), any
+    other relationship access on the loaded objects raises instead of
+    quietly emitting more SELECTs.
+
+    Args:
+        session (Session): SQLAlchemy Session object.
+        event (Event): SQLAlchemy Event wrapper.
+    Returns:
+        Event: The same event, refreshed from the database.
+    """
+    options = [selectinload(Event.stations).
+               selectinload(Station.channels).
+               selectinload(Channel.pgms)]
+    if os.environ.get(RAISELOAD):
+        options.append(raiseload('*'))
+    query = select(Event).\
+        options(*options).\
+        where(Event.id == event.id).\
+        execution_options(populate_existing=True)
+    return session.scalars(query).one()
+
 
 def associate(session, event):
     """Find peak ground motions likely associated with the event.
 
+    Only stations that are not already associated with an event are
+    considered.
+
     This event can modify the database in the following ways:
      - Set event_id field of station rows to event.id
      - Delete station/channel/pgm rows where stations appear to be duplicates.
@@ -392,60 +521,73 @@ def associate(session, event):
     eqlon = event.lon
     stime = eqtime - timedelta(seconds=TMIN)
     etime = eqtime + timedelta(seconds=TMAX)
-    query = session.query(Station.id,
-                          Station.network,
-                          Station.name,
-                          Station.code,
-                          Station.timestamp,
-                          Station.lat,
-                          Station.lon,
-                          ).with_for_update()
-    query = query.filter(and_(Station.timestamp > stime,
-                              Station.timestamp < etime))
-
-    srows = query.all()
-    cols = ['id', 'network', 'name', 'code', 'timestamp',
-            'lat', 'lon']
-    stations = pd.DataFrame(srows, columns=cols)
-    stations['distance'] = geodetic_distance(eqlon, eqlat,
-                                             stations['lon'],
-                                             stations['lat'])
-
-    tt = pd.to_timedelta(stations['distance'] / P_TRAVEL_TIME)
-    stations['traveltime'] = tt
-    eqtime_ts = pd.to_datetime(eqtime)
-    tbefore = (eqtime_ts - timedelta(seconds=TMIN))
-    tafter = (eqtime_ts + timedelta(seconds=TMAX))
-    close_before = stations['timestamp'] > tbefore
-    close_after = stations['timestamp'] < tafter
-    stations['inside_time'] = close_before & close_after
-    stations['inside_distance'] = stations['distance'] < DISTANCE
-    stations['dt'] = ((eqtime_ts - stations['timestamp']).abs() -
-                      stations['traveltime']).abs()
-
-    # filter out stations that are outside time/distance windows
-    inside_time = stations['inside_time']
-    inside_distance = stations['inside_distance']
-    newstations = stations[inside_time & inside_distance]
-
-    # # keep the duplicate station with the smallest dt
-    keepstations = newstations.sort_values('dt',
-                                           ascending=True).\
-        drop_duplicates(['code'])
-
-    # delete those stations that are duplicates
-    junkids = set(newstations['id']) - set(keepstations['id'])
-    junkstations = session.query(Station).\
-        filter(Station.id.in_(junkids)).all()
-    for junkstation in junkstations:
-        session.delete(junkstation)
-
-    in_expression = Station.id.in_(newstations['id'])
-    udict = {Station.event_id: event.id}
-    session.query(Station).\
-        filter(in_expression).update(udict,
-                                     synchronize_session='fetch')
+    query = select(Station.id,
+                   Station.code,
+                   Station.timestamp,
+                   Station.lat,
+                   Station.lon,
+                   ).with_for_update()
+    query = query.where(Station.event_id.is_(None))
+    query = query.where(and_(Station.timestamp > stime,
+                             Station.timestamp < etime))
+    # let the database discard stations well outside of DISTANCE
+    minlat, maxlat, lonranges = _bounding_box(eqlat, eqlon, DISTANCE)
+    query = query.where(Station.lat.between(minlat, maxlat))
+    if lonranges is not None:
+        query = query.where(or_(*[Station.lon.between(minlon, maxlon)
+                                  for minlon, maxlon in lonranges]))
+
+    srows = session.execute(query).all()
+    # most events have no candidate stations at all; don't spend any
+    # time on building and filtering empty arrays for them
+    if not len(srows):
+        session.commit()
+        return
+    ids, codes, timestamps, lats, lons = zip(*srows)
+    ids = np.array(ids)
+    codes = np.array(codes)
+    timestamps = np.array(timestamps, dtype='datetime64[us]')
+    lats = np.array(lats, dtype=np.float64)
+    lons = np.array(lons, dtype=np.float64)
+
+    # The query has already restricted the stations to the time window
+    # and the bounding box; the exact distance only has to trim the
+    # corners of the box
+    distance = geodetic_distance(eqlon, eqlat, lons, lats)
+    inside = distance < DISTANCE
+    ids, codes, timestamps = ids[inside], codes[inside], timestamps[inside]
+    distance = distance[inside]
+
+    # dt is the mismatch (in seconds) between the station's peak time and
+    # the P-wave arrival expected at its distance
+    traveltime = distance / P_TRAVEL_TIME
+    offset = (np.datetime64(eqtime, 'us') - timestamps) / \
+        np.timedelta64(1, 's')
+    dt = np.abs(np.abs(offset) - traveltime)
+
+    # keep the duplicate station with the smallest dt
+    order = np.argsort(dt, kind='stable')
+    _, first = np.unique(codes[order], return_index=True)
+    keepids = ids[order[first]].tolist()
+
+    # delete those stations that are duplicates, without loading them
+    junkids = set(ids.tolist()) - set(keepids)
+    if len(junkids):
+        stmt = delete(Station).\
+            where(Station.id.in_(junkids)).\
+            execution_options(synchronize_session=False)
+        session.execute(stmt)
+
+    # one UPDATE for all kept stations; rather than synchronizing the
+    # session, just make sure the event's stations are reloaded on access
+    if len(keepids):
+        stmt = update(Station).\
+            where(Station.id.in_(keepids)).\
+            values(event_id=event.id).\
+            execution_options(synchronize_session=False)
+        session.execute(stmt)
     session.commit()
+    session.expire(event, ['stations'])
 
 
 def clean_database():
@@ -460,61 +602,89 @@ def clean_database():
     db_url = os.environ[DB_URL]
     session = get_session(db_url)
 
-    amp_threshold = datetime.utcnow() - timedelta(days=MAX_AMP_AGE)
-    event_threshold = datetime.utcnow() - timedelta(days=MAX_EVENT_AGE)
-
-    namps = session.query(Station).\
-        filter(Station.loadtime < amp_threshold).count()
-    nevents = session.query(Event).\
-        filter(Event.time < event_threshold).count()
-
-    # delete old amps
-    amps = session.query(Station).\
-        filter(Station.loadtime < amp_threshold).all()
-    for amp in amps:
-        session.delete(amp)
-        session.commit()
-
-    # delete old earthquakes
-    events = session.query(Event).filter(Event.time < event_threshold).all()
-    for event in events:
-        session.delete(event)
+    now = datetime.utcnow()
+    amp_threshold = now - timedelta(days=MAX_AMP_AGE)
+    event_threshold = now - timedelta(days=MAX_EVENT_AGE)
+
+    # Delete old amps and earthquakes with one statement each; the
+    # database cascades the deletes down to the channels and pgms, so
+    # nothing needs to be loaded into (or synchronized with) the session
+    stmt = delete(Station).\
+        where(Station.loadtime < amp_threshold).\
+        execution_options(synchronize_session=False)
+    namps = session.execute(stmt).rowcount
+    stmt = delete(Event).\
+        where(Event.time < event_threshold).\
+        execution_options(synchronize_session=False)
+    nevents = session.execute(stmt).rowcount
 
     # commit changes, and close the session
     session.commit()
+    session.close()
 
     return (namps, nevents)
 
 
-def write_event_to_s3(event):
+def write_event_to_s3(event, s3_client=None):
     """Write event.xml file to S3.
 
     Args:
         event (Event): SQLAlchemy Event object.
+        s3_client (S3.Client): boto3 S3 client, or None to use the
+                               shared one.
     """
     eventjson = get_metrics_json(event)
-    transfer_config = TransferConfig(multipart_threshold=PAYLOAD_LIMIT,
-                                     max_concurrency=10,
-                                     multipart_chunksize=PAYLOAD_LIMIT,
-                                     use_threads=True)
-    s3_client = boto3.client('s3')
-    key = '/'.join(['events', event.eventid, 'input', 'event.xml'])
+    if s3_client is None:
+        s3_client = _get_s3_client()
+    return _put_event_json(s3_client, event.eventid, eventjson)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_s3_client():
+    """Get the process-wide boto3 S3 client.
+
+    The client is created once, so credential resolution and endpoint
+    setup are paid once and every upload (from any thread) reuses the
+    same keep-alive connection pool.
+
+    Returns:
+        S3.Client: boto3 S3 client.
+    """
+    config = Config(max_pool_connections=2 * MAX_UPLOAD_WORKERS,
+                    retries={'mode': 'adaptive'})
+    return boto3.client('s3', config=config)
+
+
+def _put_event_json(s3_client, eventid, eventjson):
+    """Upload event JSON to S3 in a single PUT.
+
+    The payloads are far below the multipart threshold, so a plain
+    put_object is cheaper than a managed transfer.
+
+    Args:
+        s3_client (S3.Client): boto3 S3 client.
+        eventid (str): Event ID.
+        eventjson (bytes): Event JSON, from get_metrics_json().
+    Returns:
+        bool: True when the upload succeeded.
+    """
+    key = '/'.join(['events', eventid, 'input', 'event.xml'])
     bucket = get_bucket()
-    extra = {'ACL': 'public-read',
-             'ContentType': 'text/json'}
-    s3_client.upload_fileobj(eventjson, bucket, key,
-                             ExtraArgs=extra,
-                             Config=transfer_config)
+    s3_client.put_object(Body=eventjson,
+                         Bucket=bucket,
+                         Key=key,
+                         ACL='public-read',
+                         ContentType='application/json')
     return True
 
 
 def get_metrics_json(event):
-    """Return string representation of event object.
+    """Return JSON representation of event object.
 
     Args:
         event (Event): SQLAlchemy Event object.
     Returns:
-        str: XML string.
+        bytes: UTF-8 encoded JSON.
     """
     tnow = datetime.utcnow().strftime(TIMEFMT)
     json_dict = {'type': 'FeatureCollection',
@@ -529,45 +699,56 @@ def get_metrics_json(event):
                            'magnitude': event.magnitude,
                            }
                  }
-    features = []
-    for station in event.stations:
-        feature = {'geometry': {'type': 'Point',
-                                'coordinates': (station.lon, station.lat)
-                                },
-                   'type': 'Feature',
-                   'properties': {"network_code": station.network,
-                                  "station_code": station.code,
-                                  "name": station.name,
-                                  "provider": "NEIC ShakeMap",
-                                  }
-                   }
-
-        components = {}
-        for channel in station.channels:
-            component = {}
-            spectrals = []
-            for pgm in channel.pgms:
-                pgmdict = {'value': pgm.value}
-                pgmname = pgm.imt.upper()
-                if 'sa' in pgm.imt:
-                    period = float(re.search(FLOAT_PATTERN, pgm.imt).group())
-                    pgmdict['period'] = period / 10.0
-                    pgmdict['damping'] = 0.05
-                    pgmname = 'SA'
-                    pgmdict['units'] = UNITS[pgmname]
-                    spectrals.append(pgmdict)
-                else:
-                    pgmdict['units'] = UNITS[pgmname]
-                    component[pgmname] = pgmdict
-            if len(spectrals):
-                component['SA'] = spectrals
-            components[channel.channel] = component
-
-        feature['properties']['components'] = components
-        features.append(feature)
+    features = [_station_feature(station) for station in event.stations]
     json_dict['features'] = features
-    jsonstr = json.dumps(json_dict)
-    return jsonstr
+    jsonbytes = orjson.dumps(json_dict)
+    return jsonbytes
+
+
+def _station_feature(station):
+    """Build the GeoJSON feature for one associated station.
+
+    Args:
+        station (Station): SQLAlchemy Station object.
+    Returns:
+        dict: Feature dictionary, with one component per channel.
+    """
+    sa_units = UNITS['SA']
+    components = {}
+    for channel in station.channels:
+        component = {}
+        spectrals = []
+        for pgm in channel.pgms:
+            imt = pgm.imt
+            value = pgm.value
+            if 'sa' in imt:
+                # imt is 'psa' + the period with the decimal point dropped
+                spectrals.append({'value': value,
+                                  'period': float(imt[3:]) / 10.0,
+                                  'damping': 0.05,
+                                  'units': sa_units,
+                                  })
+            else:
+                pgmname = imt.upper()
+                component[pgmname] = {'value': value,
+                                      'units': UNITS[pgmname],
+                                      }
+        if len(spectrals):
+            component['SA'] = spectrals
+        components[channel.channel] = component
+
+    feature = {'geometry': {'type': 'Point',
+                            'coordinates': (station.lon, station.lat)
+                            },
+               'type': 'Feature',
+               'properties': {"network_code": station.network,
+                              "station_code": station.code,
+                              "name": station.name,
+                              "provider": "NEIC ShakeMap",
+                              "components": components,
+                              }
+               }
+    return feature
 
 
 def get_bucket():
@@ -597,19 +778,37 @@ def start_shakemap(eventid):
     return True
 
 
-def _prepare_coords(lons1, lats1, lons2, lats2):
+def _bounding_box(lat, lon, distance):
     """
-    Convert two pairs of spherical coordinates in decimal degrees
-    to numpy arrays of radians. Makes sure that respective coordinates
-    in pairs have the same shape.
+    Get a latitude/longitude box that contains every point within
+    distance km of (lat, lon).
+
+    The box is slightly larger than it needs to be (111 km per degree of
+    latitude), which is fine as it is only used as a coarse prefilter.
+
+    :returns:
+        Tuple of (minlat, maxlat, lonranges), where lonranges is a list
+        of (minlon, maxlon) tuples (two of them when the box crosses the
+        antimeridian), or None if the box covers a pole and so spans all
+        longitudes.
     """
-    lons1 = np.array(np.radians(lons1))
-    lats1 = np.array(np.radians(lats1))
-    assert lons1.shape == lats1.shape
-    lons2 = np.array(np.radians(lons2))
-    lats2 = np.array(np.radians(lats2))
-    assert lons2.shape == lats2.shape
-    return lons1, lats1, lons2, lats2
+    dlat = distance / 111.0
+    minlat = lat - dlat
+    maxlat = lat + dlat
+    if minlat <= -90.0 or maxlat >= 90.0:
+        return (max(minlat, -90.0), min(maxlat, 90.0), None)
+    dlon = dlat / float(np.cos(np.radians(abs(lat) + dlat)))
+    if dlon >= 180.0:
+        return (minlat, maxlat, None)
+    minlon = lon - dlon
+    maxlon = lon + dlon
+    if minlon < -180.0:
+        lonranges = [(minlon + 360.0, 180.0), (-180.0, maxlon)]
+    elif maxlon > 180.0:
+        lonranges = [(minlon, 180.0), (-180.0, maxlon - 360.0)]
+    else:
+        lonranges = [(minlon, maxlon)]
+    return (minlat, maxlat, lonranges)
 
 
 def geodetic_distance(lons1, lats1, lons2, lats2):
@@ -623,13 +822,42 @@ def geodetic_distance(lons1, lats1, lons2, lats2):
 
     Implements http://williams.best.vwh.net/avform.htm#Dist
 
+    The haversine terms are accumulated in place in two preallocated
+    buffers, so only a couple of temporaries are created per call
+    regardless of the number of points.
+
     :returns:
         Distance in km, floating point scalar or numpy array of such.
     """
-    lons1, lats1, lons2, lats2 = _prepare_coords(lons1, lats1, lons2, lats2)
-    distance = np.arcsin(np.sqrt(
-        np.sin((lats1 - lats2) / 2.0) ** 2.0
-        + np.cos(lats1) * np.cos(lats2)
-        * np.sin((lons1 - lons2) / 2.0) ** 2.0
-    ).clip(-1., 1.))
-    return (2.0 * EARTH_RADIUS) * distance
+    deg2rad = np.pi / 180.0
+    lons1 = np.asarray(lons1, dtype=np.float64) * deg2rad
+    lats1 = np.asarray(lats1, dtype=np.float64) * deg2rad
+    lons2 = np.asarray(lons2, dtype=np.float64) * deg2rad
+    lats2 = np.asarray(lats2, dtype=np.float64) * deg2rad
+    assert lons1.shape == lats1.shape
+    assert lons2.shape == lats2.shape
+    shape = np.broadcast_shapes(lons1.shape, lons2.shape)
+
+    # sin^2(dlat / 2)
+    distance = np.empty(shape)
+    np.subtract(lats1, lats2, out=distance)
+    distance *= 0.5
+    np.sin(distance, out=distance)
+    np.square(distance, out=distance)
+
+    # cos(lat1) * cos(lat2) * sin^2(dlon / 2)
+    buf = np.empty(shape)
+    np.subtract(lons1, lons2, out=buf)
+    buf *= 0.5
+    np.sin(buf, out=buf)
+    np.square(buf, out=buf)
+    buf *= np.cos(lats1)
+    buf *= np.cos(lats2)
+
+    distance += buf
+    np.sqrt(distance, out=distance)
+    np.clip(distance, -1., 1., out=distance)
+    np.arcsin(distance, out=distance)
+    distance *= 2.0 * EARTH_RADIUS
+    # unwrap 0-d results back to a scalar
+    return distance[()]
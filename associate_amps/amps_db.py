@@ -3,11 +3,12 @@ import logging
 from datetime import datetime, timedelta
 
 # third party imports
-from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import (Column, Integer, Float, String,
-                        DateTime, ForeignKey, Boolean)
+                        DateTime, ForeignKey, Boolean, Index)
 from sqlalchemy import create_engine, event
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 from sqlalchemy_utils import database_exists, create_database
 
 # We dynamically (not sure why?) create the base class for our objects
@@ -17,6 +18,33 @@ TIMEFMT = '%Y-%m-%dT%H:%M:%S'
 
 MYSQL_TIMEOUT = 30
 
+# pragmas for every sqlite connection (64 MB page cache)
+SQLITE_PRAGMAS = ['foreign_keys=ON',
+                  'cache_size=-65536',
+                  'temp_store=MEMORY',
+                  ]
+
+# pragmas for file-backed sqlite connections (256 MB mmap)
+SQLITE_FILE_PRAGMAS = ['journal_mode=WAL',
+                       'synchronous=NORMAL',
+                       'mmap_size=268435456',
+                       ]
+
+# maximum number of rows per multi-row INSERT..RETURNING statement
+INSERT_PAGE_SIZE = 10000
+
+# number of compiled SQL statements each engine keeps for reuse
+QUERY_CACHE_SIZE = 1200
+
+# connection pool settings for database servers
+POOL_SIZE = 10
+POOL_MAX_OVERFLOW = 20
+POOL_RECYCLE = 3600
+
+# sessionmakers (bound to their engines) that have already been set up,
+# keyed by database URL
+_SESSIONMAKERS = {}
+
 # association algorithm - any peak with:
 # time > origin - TMIN and time < origin + TMAX
 # AND
@@ -35,22 +63,58 @@ class IncompleteConstructorException(Exception):
     pass
 
 
-def _fk_pragma_on_connect(dbapi_con, con_record):
-    # use of this ensures that foreign key delete cascade
-    # directives will be obeyed, at least in sqlite.
-    dbapi_con.execute('pragma foreign_keys=ON')
+def _sqlite_pragma_on_connect(dbapi_con, con_record):
+    # foreign keys must be switched on for the delete cascade
+    # directives to be obeyed; the larger page cache and in-memory
+    # temp tables help the event and station lookups on any sqlite
+    # database, in memory or on disk.
+    cursor = dbapi_con.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f'pragma {pragma}')
+    cursor.close()
+
+
+def _wal_pragma_on_connect(dbapi_con, con_record):
+    # write-ahead logging lets a commit skip most fsyncs, which is
+    # what ingest time on sqlite is bound by; it only applies to
+    # databases backed by a file.
+    cursor = dbapi_con.cursor()
+    for pragma in SQLITE_FILE_PRAGMAS:
+        cursor.execute(f'pragma {pragma}')
+    cursor.close()
 
 
-def get_session(url='sqlite:///:memory:', create_db=True):
+def get_session(url='sqlite:///:memory:', create_db=True, bind=None):
     """Get a SQLAlchemy Session instance for input database URL.
+
+    The engine (and with it the connection pool) is built once per URL
+    and shared by every session for the life of the process, so only
+    the first call pays for the connection setup and the table checks.
+    In-memory databases only live as long as their engine, so those get
+    a new engine every time.
+
     :param url:
       SQLAlchemy URL for database, described here:
         http://docs.sqlalchemy.org/en/latest/core/engines.html#database-urls.
     :param create_db:
       Boolean indicating whether to create database from scratch.
+    :param bind:
+      Existing Engine or Connection to use instead of url; its tables
+      must already exist.
     :returns:
       Sqlalchemy Session instance.
     """
+    if bind is not None:
+        return sessionmaker(bind=bind, autoflush=False,
+                            expire_on_commit=False)()
+    if url in _SESSIONMAKERS:
+        return _SESSIONMAKERS[url]()
+
+    sa_url = make_url(url)
+    is_sqlite = sa_url.get_backend_name() == 'sqlite'
+    # 'sqlite://' and 'sqlite:///:memory:' are both in-memory databases
+    in_memory = is_sqlite and sa_url.database in (None, '', ':memory:')
+
     # Create a sqlite in-memory database engine
     if not database_exists(url):
         if create_db:
@@ -62,18 +126,50 @@ def get_session(url='sqlite:///:memory:', create_db=True):
             return None
 
     connect_args = {}
+    # let flushes that need new primary keys back (such as the channel
+    # batch) go out as large multi-row INSERT..RETURNING statements, and
+    # keep every statement we run compiled in the engine's cache
+    kwargs = {'insertmanyvalues_page_size': INSERT_PAGE_SIZE,
+              'query_cache_size': QUERY_CACHE_SIZE,
+              }
     if 'mysql' in url.lower():
         connect_args = {'connect_timeout': MYSQL_TIMEOUT}
-
-    engine = create_engine(url, echo=False, connect_args=connect_args)
-    if 'sqlite' in url:
+    if url.startswith(('postgresql://', 'postgresql+psycopg2://')):
+        # psycopg2 also pages plain executemany INSERTs, like the PGM
+        # bulk load, into multi-row VALUES statements
+        kwargs['executemany_mode'] = 'values_plus_batch'
+    if in_memory:
+        # an in-memory database lives in its one connection, so every
+        # session (from any thread) has to share it
+        connect_args = {'check_same_thread': False}
+        kwargs['poolclass'] = StaticPool
+    if not is_sqlite:
+        # the engine is long-lived, so check connections before use and
+        # recycle them before the server times them out
+        kwargs.update({'pool_size': POOL_SIZE,
+                       'max_overflow': POOL_MAX_OVERFLOW,
+                       'pool_pre_ping': True,
+                       'pool_recycle': POOL_RECYCLE,
+                       })
+
+    engine = create_engine(url, echo=False, connect_args=connect_args,
+                           **kwargs)
+    if is_sqlite:
         # make sure that we enable foreign keys when using sqlite
-        event.listen(engine, 'connect', _fk_pragma_on_connect)
+        event.listen(engine, 'connect', _sqlite_pragma_on_connect)
+        if not in_memory:
+            event.listen(engine, 'connect', _wal_pragma_on_connect)
     Base.metadata.create_all(engine)
 
     # create a session object that we can use to insert and
-    # extract information from the database
-    Session = sessionmaker(bind=engine, autoflush=False)
+    # extract information from the database; objects are not expired on
+    # commit, so code that reads them afterwards doesn't reload every
+    # row (anything that needs fresh state after a bulk statement has
+    # to expire or re-query it explicitly)
+    Session = sessionmaker(bind=engine, autoflush=False,
+                           expire_on_commit=False)
+    if not in_memory:
+        _SESSIONMAKERS[url] = Session
     session = Session()
 
     return session
@@ -87,7 +183,7 @@ class Event(Base):
     id = Column(Integer(), primary_key=True)
     eventid = Column(String(64), index=True)
     netid = Column(String(32))
-    time = Column(DateTime())
+    time = Column(DateTime(), index=True)
     lat = Column(Float())
     lon = Column(Float())
     depth = Column(Float())
@@ -108,6 +204,11 @@ class Event(Base):
 
 class Station(Base):
     __tablename__ = 'station'
+    # association looks for unassociated stations in a time window and
+    # a lat/lon box
+    __table_args__ = (Index('ix_station_evt_time', 'event_id', 'timestamp'),
+                      Index('ix_station_latlon', 'lat', 'lon'),
+                      )
     id = Column(Integer(), primary_key=True)
     event_id = Column(Integer(),
                       ForeignKey('event.id', ondelete='CASCADE'),
@@ -119,7 +220,7 @@ class Station(Base):
     network = Column(String(32), index=True)
     name = Column(String(1024))
     code = Column(String(32), index=True)
-    loadtime = Column(DateTime())
+    loadtime = Column(DateTime(), index=True)
 
     # a station can have one event
     event = relationship("Event", back_populates='stations')
@@ -156,6 +257,9 @@ class Channel(Base):
 
 class PGM(Base):
     __tablename__ = 'pgm'
+    # pgms are looked up (and checked for existing imts) by channel
+    __table_args__ = (Index('ix_pgm_channel_imt', 'channel_id', 'imt'),
+                      )
     id = Column(Integer(), primary_key=True)
     channel_id = Column(Integer(),
                         ForeignKey('channel.id', ondelete='CASCADE'),
@@ -19,7 +19,7 @@ source $prof
 # Name of virtual environment
 VENV=associate_amps
 
-py_ver=3.8
+py_ver=3.9
 
 echo "Using python version $py_ver"
 
@@ -82,12 +82,13 @@ package_list=(
       "ipython"
       "defusedxml"
       "pymysql"
-      "pandas"
+      "mysqlclient"
       "numpy"
+      "orjson"
       "pyyaml"
       "pytest"
       "pytest-cov"
-      "sqlalchemy"
+      "sqlalchemy>=2.0"
       "sqlalchemy-utils"
 )
 
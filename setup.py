@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 
 setup(name='associate_amps',
@@ -10,13 +10,13 @@ setup(name='associate_amps',
           'associate_amps',
       ],
       install_requires=[
-          'pandas',
           'PyYAML',
           'boto3',
-          'sqlalchemy',
+          'sqlalchemy>=2.0',
           'sqlalchemy_utils',
           'defusedxml',
           'numpy',
+          'orjson',
       ],
-
+      python_requires='>=3.9',
       )
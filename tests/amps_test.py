@@ -6,9 +6,15 @@ import tempfile
 import pathlib
 import os.path
 import json
+import io
 from unittest import mock
 import time
 
+# third party imports
+import pytest
+import numpy as np
+from numpy.testing import assert_almost_equal
+
 from associate_amps.amps_db import Event, Station, Channel, PGM, get_session
 from associate_amps.amps import (insert_event,
                                  insert_amps,
@@ -16,15 +22,18 @@ from associate_amps.amps import (insert_event,
                                  associate,
                                  associate_amps,
                                  clean_database,
+                                 geodetic_distance,
+                                 _bounding_box,
+                                 _parse_amps,
+                                 DISTANCE,
                                  TIMEFMT)
 
 
 class MockS3Client(object):
     """Mock boto3 S3 client"""
 
-    def upload_fileobj(self, eventxml, bucket, key,
-                       ExtraArgs=None,
-                       Config=None):
+    def put_object(self, Body=None, Bucket=None, Key=None,
+                   ACL=None, ContentType=None):
         return None
 
 
@@ -68,17 +77,21 @@ def test_amps():
         assert len(jdict['features']) == 1
         assert len(jdict['features'][0]['properties']['components']) == 3
         # assert jsonstr == CMPSTR
-        # undo the association
+        # undo the association; the bulk update doesn't synchronize the
+        # session, and commits don't expire it, so expire it here
         udict = {Station.event_id: None}
         session.query(Station).\
             filter(Station.event_id == event.id).\
-            update(udict, synchronize_session='fetch')
+            update(udict, synchronize_session=False)
+        session.expire_all()
         session.commit()
         session.close()
 
         # now test the associate algorithm
         os.environ['S3_BUCKET_URL'] = 'foo'
-        with mock.patch('boto3.client', return_value=MockS3Client()) as _:
+        mock_client = 'associate_amps.amps._get_s3_client'
+        with mock.patch.dict(os.environ, {'AMPS_RAISELOAD': '1'}), \
+                mock.patch(mock_client, return_value=MockS3Client()) as _:
             associate_amps()
 
         # now test the cleaning algorithm
@@ -109,6 +122,211 @@ def test_amps():
         shutil.rmtree(tdir)
 
 
+def test_parse_amps():
+    root = pathlib.Path(__file__).absolute().parent
+    datadir = root / 'data'
+
+    # several station elements in the record: the station comes from
+    # the first, and the components from all of them
+    with open(datadir / 'USR_100416_20180307_180450.xml', 'rb') as fh:
+        amps = _parse_amps(fh)
+    assert amps['tag'] == 'amplitudes'
+    assert amps['agency'] == 'NCSN'
+    assert amps['pgmtime'] == '2018-03-07T18:04:49.845Z'
+    assert amps['station']['code'] == 'RWSVT'
+    cnames = [channel['name'] for channel, _ in amps['components']]
+    assert cnames == ['HN3', 'HN2', 'HNZ']
+    imts = [imt for imt, _ in amps['components'][1][1]]
+    assert imts == ['pga', 'pgv', 'pgd', 'sa', 'sa', 'sa']
+    assert amps['components'][1][1][0][1]['value'] == '0.0360'
+
+    # no PGMTime, so the reference time fields are used instead
+    with open(datadir / 'TA109C_BH..2018_095_193003x.xml', 'rb') as fh:
+        amps = _parse_amps(fh)
+    assert amps['pgmtime'] is None
+    assert amps['time_dict'] == {'year': 2018, 'month': 4, 'day': 5,
+                                 'hour': 19, 'minute': 29, 'second': 54,
+                                 'msec': 0}
+    # this record has two stations, and (as with the file above) the
+    # components of both are read
+    assert amps['station']['code'] == '109C'
+    assert len(amps['components']) == 6
+
+    # non-ASCII bytes in a US-ASCII document are replaced with spaces,
+    # and only the first of several records is read
+    xmlbytes = '''<?xml version="1.0" encoding="US-ASCII"?>
+<amplitudes agency="NC">
+<record>
+<timing><reference><PGMTime>2018-03-07T18:04:49Z</PGMTime></reference>
+</timing>
+<station code="ABC" net="NC" lat="37.9" lon="-122.2" name="Caf\u00e9">
+<component name="HNE"><pga value="0.1" units="cm/s/s"/></component>
+</station>
+</record>
+<record>
+<timing><reference><PGMTime>2018-03-07T18:05:49Z</PGMTime></reference>
+</timing>
+<station code="DEF" net="NC" lat="37.9" lon="-122.2" name="Other">
+<component name="HNN"><pga value="0.2" units="cm/s/s"/></component>
+</station>
+</record>
+</amplitudes>
+'''.encode('utf-8')
+    amps = _parse_amps(io.BytesIO(xmlbytes))
+    assert amps['pgmtime'] == '2018-03-07T18:04:49Z'
+    assert amps['station']['name'] == 'Caf '
+    assert [c['name'] for c, _ in amps['components']] == ['HNE']
+
+    # anything other than an amplitudes document is left for the caller
+    # to reject
+    xmlbytes = b'<?xml version="1.0"?><quakeml><event/></quakeml>'
+    amps = _parse_amps(io.BytesIO(xmlbytes))
+    assert amps['tag'] == 'quakeml'
+    assert amps['station'] is None
+    assert amps['components'] == []
+    with tempfile.NamedTemporaryFile(suffix='.xml') as fh:
+        fh.write(xmlbytes)
+        fh.flush()
+        with mock.patch.dict(os.environ, {'DB_URL': 'sqlite://'}):
+            with pytest.raises(Exception, match='amplitude XML'):
+                insert_amps(pathlib.Path(fh.name).as_uri())
+
+
+def test_insert_duplicate_amps():
+    try:
+        tdir = tempfile.mkdtemp()
+        dbfile = pathlib.Path(tdir) / 'test.db'
+        dburl = dbfile.as_uri().replace('file:', 'sqlite:/')
+        os.environ['DB_URL'] = dburl
+        root = pathlib.Path(__file__).absolute().parent
+        datadir = root / 'data'
+        xmlfile1 = (datadir / 'USR_100416_20180307_180450.xml').as_uri()
+        # same station and channels, one second later
+        xmlfile5 = (datadir / 'USR_100416_20180307_180450_5.xml').as_uri()
+
+        # re-inserting a file, or a file for the same station a few
+        # seconds apart, should find the stored station and add nothing
+        for ampsurl in [xmlfile1, xmlfile1, xmlfile5]:
+            insert_amps(ampsurl)
+            session = get_session(dburl)
+            assert session.query(Station).count() == 1
+            assert session.query(Channel).count() == 3
+            assert session.query(PGM).count() == 15
+            session.close()
+    except Exception as e:
+        raise(e)
+    finally:
+        shutil.rmtree(tdir)
+
+
+def test_upload_failure():
+    event1 = {'eventid': 'ci37889959',
+              'ids': [],
+              'netid': 'ci',
+              'time': datetime(2018, 3, 7, 18, 5, 0),
+              'lat': 35.487,
+              'lon': -120.027,
+              'depth': 8.0,
+              'locstring': 'Somewhere in California',
+              'magnitude': 3.7}
+    try:
+        tdir = tempfile.mkdtemp()
+        dbfile = pathlib.Path(tdir) / 'test.db'
+        dburl = dbfile.as_uri().replace('file:', 'sqlite:/')
+        os.environ['DB_URL'] = dburl
+        insert_event(event1)
+        root = pathlib.Path(__file__).absolute().parent
+        xmlfile1 = (root / 'data' / 'USR_100416_20180307_180450.xml').as_uri()
+        insert_amps(xmlfile1)
+
+        # a failed upload should hand the stations back, unassociated
+        mock_client = 'associate_amps.amps._get_s3_client'
+        failing_client = mock.Mock()
+        failing_client.put_object.side_effect = Exception('upload failed')
+        with mock.patch.dict(os.environ, {'S3_BUCKET_URL': 'foo'}), \
+                mock.patch(mock_client, return_value=failing_client) as _:
+            with pytest.raises(Exception, match='upload failed'):
+                associate_amps()
+        assert failing_client.put_object.call_count == 1
+        session = get_session(dburl)
+        slist = session.query(Station.event_id, Station.code).all()
+        assert slist == [(None, 'RWSVT')]
+        session.close()
+
+        # so the next run uploads them again, and then deletes them
+        s3_client = mock.Mock()
+        with mock.patch.dict(os.environ, {'S3_BUCKET_URL': 'foo'}), \
+                mock.patch(mock_client, return_value=s3_client) as _:
+            associate_amps()
+        assert s3_client.put_object.call_count == 1
+        kwargs = s3_client.put_object.call_args.kwargs
+        assert kwargs['Key'] == 'events/ci37889959/input/event.xml'
+        assert len(json.loads(kwargs['Body'])['features']) == 1
+        session = get_session(dburl)
+        assert session.query(Station).count() == 0
+        session.close()
+    except Exception as e:
+        raise(e)
+    finally:
+        shutil.rmtree(tdir)
+
+
+def _points_within(lat, lon, distance, npoints=20000):
+    # random points scattered around (lat, lon), and the ones that are
+    # actually within distance km of it
+    rng = np.random.default_rng(1234)
+    lats = np.clip(lat + rng.uniform(-6, 6, npoints), -90, 90)
+    lons = (lon + rng.uniform(-180, 180, npoints) + 180) % 360 - 180
+    inside = geodetic_distance(lon, lat, lons, lats) < distance
+    return lats[inside], lons[inside]
+
+
+def test_geodetic_distance():
+    # scalars, lists and (possibly empty) object arrays of coordinates,
+    # like the columns of a query result, are all accepted
+    assert_almost_equal(geodetic_distance(0, 0, 1, 1), 157.249, decimal=3)
+    assert_almost_equal(geodetic_distance(0.0, 0.0, [1.0], [1.0]),
+                        [157.249], decimal=3)
+    lons = np.array([0.0, 180.0], dtype=object)
+    lats = np.array([1.0, 0.0], dtype=object)
+    assert_almost_equal(geodetic_distance(0.0, 0.0, lons, lats),
+                        [111.195, 20015.087], decimal=3)
+    empty = np.array([], dtype=object)
+    assert geodetic_distance(0.0, 0.0, empty, empty).shape == (0,)
+
+
+def test_bounding_box():
+    minlat, maxlat, lonranges = _bounding_box(0.0, 0.0, 555.0)
+    assert_almost_equal([minlat, maxlat], [-5.0, 5.0])
+    assert len(lonranges) == 1
+    assert lonranges[0][0] < -5.0 and lonranges[0][1] > 5.0
+
+    # boxes that cross the antimeridian are split in two
+    for lon in [179.0, -179.0]:
+        _, _, lonranges = _bounding_box(10.0, lon, DISTANCE)
+        assert len(lonranges) == 2
+        assert (180.0 in lonranges[0]) and (-180.0 in lonranges[1])
+
+    # boxes that cover a pole span all longitudes
+    assert _bounding_box(88.0, 0.0, DISTANCE) == \
+        (88.0 - DISTANCE / 111.0, 90.0, None)
+    assert _bounding_box(-88.0, 0.0, DISTANCE) == \
+        (-90.0, -88.0 + DISTANCE / 111.0, None)
+
+    # every point within DISTANCE has to fall in the box
+    for lat, lon in [(0.0, 0.0), (45.0, 179.5), (-60.0, -179.9),
+                     (80.0, 10.0), (87.0, 0.0), (-89.0, 90.0)]:
+        minlat, maxlat, lonranges = _bounding_box(lat, lon, DISTANCE)
+        lats, lons = _points_within(lat, lon, DISTANCE)
+        assert len(lats)
+        assert np.all((lats >= minlat) & (lats <= maxlat))
+        if lonranges is not None:
+            inbox = np.zeros(len(lons), dtype=bool)
+            for minlon, maxlon in lonranges:
+                inbox |= (lons >= minlon) & (lons <= maxlon)
+            assert np.all(inbox)
+
+
 def make_station_xml(station):
     station_str = f'''<?xml version="1.0" encoding="US-ASCII" standalone="yes"?>
 <amplitudes agency="{station['network']}">
@@ -236,6 +454,26 @@ def test_duplicates():
                 'name': 'Station 1',
                 'event_id': 0,
                 }
+    # station7 and station8 are duplicates about 434 km (a 103 second P
+    # travel time) from event1; station8 arrives when the P wave does,
+    # so it should be kept even though station7 is closer to the origin
+    # time
+    station7 = {'code': 'MNO',
+                'timestamp': t1 + timedelta(seconds=10),
+                'lat': 3.0,
+                'lon': 2.5,
+                'network': 'us',
+                'name': 'Station 1',
+                'event_id': 0,
+                }
+    station8 = {'code': 'MNO',
+                'timestamp': t1 + timedelta(seconds=105),
+                'lat': 3.0,
+                'lon': 2.5,
+                'network': 'us',
+                'name': 'Station 1',
+                'event_id': 0,
+                }
 
     try:
         tdir = tempfile.mkdtemp()
@@ -245,7 +483,8 @@ def test_duplicates():
         os.environ['DB_URL'] = dburl
         insert_event(event1)
         insert_event(event2)
-        stations = [station1, station2, station3, station4, station5, station6]
+        stations = [station1, station2, station3, station4, station5, station6,
+                    station7, station8]
         for station in stations:
             station_str = make_station_xml(station)
             sfile = pathlib.Path(tdir) / 'tmpstation.xml'
@@ -257,7 +496,7 @@ def test_duplicates():
         # check out our database, associate with one event
         session = get_session(dburl)
         assert session.query(Event).count() == 2
-        assert session.query(Station).count() == 6
+        assert session.query(Station).count() == 8
         session.close()
         event = session.query(Event).\
             filter(Event.eventid == 'us2020abcd').first()
@@ -268,14 +507,19 @@ def test_duplicates():
         session = get_session(dburl)
         event = session.query(Event).\
             filter(Event.eventid == 'us2020abcd').first()
-        assert len(event.stations) == 2
-        cmplist = [(1, 'ABC'), (1, 'DEF'), (None, 'GHI'), (None, 'JKL')]
+        assert len(event.stations) == 3
+        cmplist = [(1, 'ABC'), (1, 'DEF'), (None, 'GHI'), (None, 'JKL'),
+                   (1, 'MNO')]
         slist = session.query(Station.event_id, Station.code).all()
         assert slist == cmplist
+        mno = session.query(Station).filter(Station.code == 'MNO').one()
+        assert mno.timestamp == station8['timestamp']
         session.close()
 
         os.environ['S3_BUCKET_URL'] = 'foo'
-        with mock.patch('boto3.client', return_value=MockS3Client()) as _:
+        mock_client = 'associate_amps.amps._get_s3_client'
+        with mock.patch.dict(os.environ, {'AMPS_RAISELOAD': '1'}), \
+                mock.patch(mock_client, return_value=MockS3Client()) as _:
             associate_amps()
     except Exception as e:
         raise(e)
@@ -1,28 +1,29 @@
 #!/usr/bin/env python
 
 from datetime import datetime, timedelta
-import tempfile
-import shutil
-import pathlib
-import os.path
-import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # third party imports
 from numpy.testing import assert_almost_equal
-from sqlalchemy import inspect
+from sqlalchemy import insert, select, exists, func, event as sa_event
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import StaticPool
 
 from associate_amps.amps_db import (Event, Station,
                                     Channel, PGM,
-                                    get_session, Base)
+                                    get_session, _SESSIONMAKERS)
 
 
-def test_amps_db(user=None, password=None, host=None):
-    try:
-        if user is not None:
-            dburl = f'mysql+pymysql://{user}:{password}@{host}/amps'
-            session = get_session(dburl)
-        else:
-            session = get_session()
+def _any_rows(session, model):
+    # an EXISTS probe stops at the first row, where COUNT(*) reads them all
+    return session.scalar(select(exists().select_from(model)))
+
+
+def test_amps_db(db):
+    session = db
+    now = datetime.utcnow()
+    # keep the whole test in one transaction
+    with session.begin():
         t1 = datetime(2020, 8, 21)
         event = Event(eventid='us2020abcd',
                       netid='us',
@@ -32,77 +33,82 @@ def test_amps_db(user=None, password=None, host=None):
                       depth=10.1,
                       magnitude=5.6,
                       locstring='somewhere in california')
-        session.add(event)
-        session.commit()
-        assert str(event) == 'Event: us2020abcd'
-        age_in_days = (datetime.utcnow() - t1) / timedelta(days=1)
-        assert_almost_equal(event.age_in_days, age_in_days, decimal=1)
-        station = Station(event_id=event.id,
+        # link the rows through their relationships, so that adding the
+        # event cascades to the rest and one flush inserts them in order
+        # and fills in the foreign keys
+        station = Station(event=event,
                           timestamp=datetime(2020, 8, 21, 0, 0, 30),
                           lat=32.456,
                           lon=-118.456,
                           network='ci',
                           name='Station 1',
                           code='ABCD',
-                          loadtime=datetime.utcnow())
-        session.add(station)
-        session.commit()
-        assert str(station) == 'Station: ABCD, Station 1'
-        channel = Channel(station_id=station.id,
+                          loadtime=now)
+        channel = Channel(station=station,
                           channel='HNE',
                           loc='01')
-        session.add(channel)
-        session.commit()
-        assert str(channel) == 'Channel: HNE'
-        pgm = PGM(channel_id=channel.id,
+        pgm = PGM(channel=channel,
                   imt='PGA',
                   value=1.0)
-        session.add(pgm)
-        session.commit()
+        session.add(event)
+        session.flush()
+        assert str(event) == 'Event: us2020abcd'
+        age_in_days = (now - t1) / timedelta(days=1)
+        assert_almost_equal(event.age_in_days, age_in_days, decimal=1)
+        assert str(station) == 'Station: ABCD, Station 1'
+        assert str(channel) == 'Channel: HNE'
         assert str(pgm) == 'PGM: PGA = 1.0'
 
-        # now test relationships
+        # now test relationships, as loaded back from the database with
+        # one query per level
+        query = select(Event).\
+            options(selectinload(Event.stations).
+                    selectinload(Station.channels).
+                    selectinload(Channel.pgms)).\
+            where(Event.id == event.id).\
+            execution_options(populate_existing=True)
+        event = session.scalars(query).one()
         assert len(event.stations) == 1
         assert len(station.channels) == 1
         assert len(channel.pgms) == 1
 
         # test counts
-        assert session.query(Station).count() == 1
-        assert session.query(Channel).count() == 1
-        assert session.query(PGM).count() == 1
+        assert session.get(Station, station.id) is not None
+        assert session.get(Channel, channel.id) is not None
+        assert session.get(PGM, pgm.id) is not None
 
         # now test cascading deletes
         # this should delete all channels, which should trigger pgm deletes as well
-        session.delete(station)
-        session.commit()
-
-        assert session.query(Station).count() == 0
-        assert session.query(Channel).count() == 0
-        assert session.query(PGM).count() == 0
-    except Exception as e:
-        raise(e)
-    finally:
-        engine = session.get_bind()
-        inspector = inspect(engine)
-        tables = inspector.get_table_names()
-        print(f'Dropping all tables {tables}')
-        session.commit()
-        # this deletes the tables from the database
-        Base.metadata.drop_all(bind=engine)
-
-    session.close()
-
-
-def test_delete_file(user=None, password=None, host=None):
-    try:
-        tdir = tempfile.mkdtemp()
-        if user is not None:
-            dburl = f'mysql+pymysql://{user}:{password}@{host}/amps'
-        else:
-            dbfile = pathlib.Path(tdir) / 'test.db'
-            dburl = dbfile.as_uri().replace('file:', 'sqlite:/')
-        os.environ['DB_URL'] = dburl
-        session = get_session(dburl)
+        # the channels were loaded above; with them unloaded again
+        # (passive_deletes), this is a single DELETE of the station and
+        # the database's ON DELETE CASCADE does the rest
+        session.expire(station, ['channels'])
+        statements = []
+
+        def _log_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        connection = session.connection()
+        sa_event.listen(connection, 'before_cursor_execute', _log_statement)
+        try:
+            session.delete(station)
+            session.flush()
+        finally:
+            sa_event.remove(connection, 'before_cursor_execute',
+                            _log_statement)
+        deletes = [stmt for stmt in statements if stmt.startswith('DELETE')]
+        assert len(deletes) == 1
+        assert deletes[0].startswith('DELETE FROM station')
+
+        assert not _any_rows(session, Station)
+        assert not _any_rows(session, Channel)
+        assert not _any_rows(session, PGM)
+
+
+def test_delete_file(db):
+    session = db
+    now = datetime.utcnow()
+    with session.begin():
         station = Station(event_id=None,
                           timestamp=datetime(2020, 8, 21, 0, 0, 30),
                           lat=32.456,
@@ -110,53 +116,49 @@ def test_delete_file(user=None, password=None, host=None):
                           network='ci',
                           name='Station 1',
                           code='ABCD',
-                          loadtime=datetime.utcnow())
-        session.add(station)
-        session.commit()
-        assert str(station) == 'Station: ABCD, Station 1'
-        channel = Channel(station_id=station.id,
+                          loadtime=now)
+        channel = Channel(station=station,
                           channel='HNE',
                           loc='01')
-        session.add(channel)
-        session.commit()
+        session.add(station)
+        session.flush()
+        assert str(station) == 'Station: ABCD, Station 1'
         assert str(channel) == 'Channel: HNE'
-        pgm = PGM(channel_id=channel.id,
-                  imt='PGA',
-                  value=1.0)
-        session.add(pgm)
-        session.commit()
+
+        # pgms go in the way insert_amps writes them, as one bulk
+        # insert that never puts objects into the session
+        pgms = [{'channel_id': channel.id, 'imt': imt, 'value': value}
+                for imt, value in [('pga', 1.0), ('pgv', 2.0)]]
+        session.execute(insert(PGM), pgms)
+        assert session.query(PGM).count() == 2
 
         # now try deleting things
         session.delete(station)
-        session.commit()
+        session.flush()
 
         # now count things
-        assert session.query(Station).count() == 0
-        assert session.query(Channel).count() == 0
-        assert session.query(PGM).count() == 0
+        assert not _any_rows(session, Station)
+        assert not _any_rows(session, Channel)
+        assert not _any_rows(session, PGM)
 
-        session.close()
-    except Exception as e:
-        raise(e)
-    finally:
+
+def test_memory_urls():
+    for url in ['sqlite://', 'sqlite:///:memory:']:
+        session = get_session(url)
         engine = session.get_bind()
-        inspector = inspect(engine)
-        tables = inspector.get_table_names()
-        print(f'Dropping all tables {tables}')
+        # each call gets its own database, in one shared connection
+        assert url not in _SESSIONMAKERS
+        assert get_session(url).get_bind() is not engine
+        assert isinstance(engine.pool, StaticPool)
+        session.add(Station(code='ABCD'))
         session.commit()
-        # this deletes the tables from the database
-        Base.metadata.drop_all(bind=engine)
-        shutil.rmtree(tdir)
-
-
-if __name__ == '__main__':
-    host = None
-    user = None
-    password = None
-    if len(sys.argv) == 4:
-        host = sys.argv[1]
-        user = sys.argv[2]
-        password = sys.argv[3]
-
-    test_amps_db(host=host, user=user, password=password)
-    test_delete_file(host=host, user=user, password=password)
+
+        # so other threads see the same tables and rows
+        def _count():
+            with get_session(bind=engine) as thread_session:
+                return thread_session.scalar(select(func.count()).
+                                             select_from(Station))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            assert executor.submit(_count).result() == 1
+        session.close()
+        engine.dispose()